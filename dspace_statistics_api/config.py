@@ -3,6 +3,10 @@ import os
 # Check if Solr connection information was provided in the environment
 SOLR_SERVER = os.environ.get("SOLR_SERVER", "http://localhost:8080/solr")
 
+# Comma-separated list of statistics cores to index, for example: statistics,
+# statistics-2018 (if empty they are discovered from Solr on each run)
+SOLR_SHARDS = os.environ.get("SOLR_SHARDS", "")
+
 DATABASE_NAME = os.environ.get("DATABASE_NAME", "dspacestatistics")
 DATABASE_USER = os.environ.get("DATABASE_USER", "dspacestatistics")
 DATABASE_PASS = os.environ.get("DATABASE_PASS", "dspacestatistics")
@@ -24,251 +24,432 @@
 # This script is written for Python 3.5+ and requires several modules that you
 # can install with pip (I recommend using a Python virtual environment):
 #
-#   $ pip install SolrClient psycopg2-binary
+#   $ pip install ijson psycopg2-binary requests
 #
-# See: https://solrclient.readthedocs.io/en/latest/SolrClient.html
 # See: https://wiki.duraspace.org/display/DSPACE/Solr
 
+import io
+import json
+import math
 import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
 
-import psycopg2.extras
+import ijson
 import requests
+from requests.adapters import HTTPAdapter
 
-from .config import SOLR_SERVER
+from .config import SOLR_SERVER, SOLR_SHARDS
 from .database import DatabaseManager
 
+# Use a persistent session for all Solr requests so that connections are kept
+# alive and reused between pages instead of being set up again for each one.
+#
+# See: https://requests.readthedocs.io/en/master/user/advanced/#session-objects
+SESSION = requests.Session()
+SESSION.mount(SOLR_SERVER, HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+# Pattern to match yearly statistics shards, for example: statistics-2018
+SHARD_PATTERN = re.compile("^statistics-[0-9]{4}$")
+
+# DSpace relies on Solr's autoCommit for statistics, so recent events might not
+# be searchable yet. We leave them out of each run and count them the next time.
+SOLR_COMMIT_LAG = timedelta(hours=1)
+
+# The number of facet buckets (items) to fetch from Solr in each "page"
+RESULTS_PER_PAGE = 10000
+
+# Item views and downloads are both faceted from the statistics core, so we ask
+# Solr for both in a single query and use a domain filter to restrict each facet
+# to the relevant documents. The keys of this dict are the names of the columns
+# in the items table that each facet populates.
+#
+# See: https://lucene.apache.org/solr/guide/7_7/json-facet-api.html
+FACETS = {
+    "views": {"field": "id", "filter": "type:2"},
+    "downloads": {"field": "owningItem", "filter": "type:0 AND bundleName:ORIGINAL"},
+}
+
 
 # Enumerate the cores in Solr to determine if statistics have been sharded into
 # yearly shards by DSpace's stats-util or not (for example: statistics-2018).
+# Returns a list of the names of all statistics cores.
 def get_statistics_shards():
-    # Initialize an empty list for statistics core years
-    statistics_core_years = []
-
-    # URL for Solr status to check active cores
+    # Use the shards from the environment if they were provided
+    shards = [shard.strip() for shard in SOLR_SHARDS.split(",") if shard.strip()]
+    if shards:
+        return shards
+
+    # URL for Solr status to check active cores. We ask Solr on every run
+    # rather than caching the shards, because when stats-util moves last
+    # year's events into a new yearly shard, the events since the previous run
+    # are only in that shard.
     solr_query_params = {"action": "STATUS", "wt": "json"}
     solr_url = SOLR_SERVER + "/admin/cores"
-    res = requests.get(solr_url, params=solr_query_params)
+    res = SESSION.get(solr_url, params=solr_query_params, timeout=60)
+
+    # Fail loudly if Solr returned an error, otherwise we would silently index
+    # only the current core and record a run without the yearly shards.
+    res.raise_for_status()
+
+    data = res.json()
+
+    # Get active yearly cores from Solr's STATUS response (cores are in the
+    # status array of this response).
+    statistics_core_years = [
+        core for core in data["status"] if SHARD_PATTERN.match(core)
+    ]
+
+    # Return the default statistics core along with any yearly shards. We
+    # query each of them separately rather than using Solr's distributed
+    # search so that we can fetch from several shards at the same time, and
+    # add up the counts for each item when we merge them in PostgreSQL.
+    return ["statistics"] + statistics_core_years
+
+
+# Parse a JSON Facet API response from Solr as a stream so that we don't need to
+# hold the whole response in memory, yielding a tuple of the facet name and the
+# number of buckets or the item id and count of each bucket as they are parsed.
+# Raises a ValueError if the response has no facets at all, for example because
+# Solr doesn't support the JSON Facet API and ignored the json.facet parameter.
+#
+# See: https://github.com/ICRAR/ijson
+def parse_facets(stream, facets):
+    found_facets = False
+
+    for prefix, event, value in ijson.parse(stream):
+        if prefix == "facets" and event == "start_map":
+            found_facets = True
+
+        # prefixes look like "facets.views.buckets.item.val"
+        try:
+            root, column, path = prefix.split(".", 2)
+        except ValueError:
+            continue
+
+        if root != "facets" or column not in facets:
+            continue
+
+        if path == "numBuckets":
+            yield column, "numBuckets", value
+        elif path == "buckets.item" and event == "start_map":
+            bucket = dict()
+        elif path == "buckets.item.val":
+            bucket["val"] = value
+        elif path == "buckets.item.count":
+            bucket["count"] = value
+        elif path == "buckets.item" and event == "end_map":
+            yield column, "bucket", (bucket["val"], bucket["count"])
+
+    if not found_facets:
+        raise ValueError(
+            "Solr response has no facets (does Solr support the JSON Facet API?)"
+        )
 
-    if res.status_code == requests.codes.ok:
-        data = res.json()
 
-        # Iterate over active cores from Solr's STATUS response (cores are in
-        # the status array of this response).
-        for core in data["status"]:
-            # Pattern to match, for example: statistics-2018
-            pattern = re.compile("^statistics-[0-9]{4}$")
+# Format a datetime for use in a Solr date range query
+def solr_datetime(dt):
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+# Fetch one "page" of item views and downloads from a statistics shard for the
+# facets in results_last_ids, starting after the last item id seen for each one
+# and using the base query parameters for this run. Returns in-memory buffers
+# with CSV rows for PostgreSQL's COPY for each facet, the new last item ids, the
+# number of buckets Solr returned on this "page" for each facet, and the total
+# number of buckets for each facet (only if count_buckets is true).
+def get_facets_page(
+    shard, solr_query_params, results_last_ids, results_per_page, count_buckets
+):
+    # Get facets sorted by item id and only ask for ids after the last one we
+    # have seen. This is much cheaper than using an offset because Solr does
+    # not have to count all the buckets on the previous pages again. We need a
+    # minimum count of 1, otherwise Solr returns all kinds of weird ids that
+    # are actually not in the database.
+    json_facet = dict()
+
+    for column, last_id in results_last_ids.items():
+        facet = FACETS[column]
+
+        domain_filters = [facet["filter"]]
+        if last_id is not None:
+            domain_filters.append(f'{facet["field"]}:{{"{last_id}" TO *]')
+
+        json_facet[column] = {
+            "type": "terms",
+            "field": facet["field"],
+            "mincount": 1,
+            "limit": results_per_page,
+            "sort": "index asc",
+            "domain": {"filter": domain_filters},
+            "numBuckets": count_buckets,
+        }
+
+    # only the facets change from one "page" to the next (copy the base query
+    # parameters so we don't modify the caller's dict from another thread)
+    solr_query_params = dict(solr_query_params)
+    solr_query_params["json.facet"] = json.dumps(json_facet)
+
+    solr_url = f"{SOLR_SERVER}/{shard}/select"
+
+    # create in-memory buffers to hold CSV rows for PostgreSQL's COPY
+    bufs = {column: io.StringIO() for column in results_last_ids}
+    # the last item ids from the previous "page", which we compare against
+    cursor_last_ids = results_last_ids
+    # copy the cursor so we don't modify the caller's dict from another thread
+    results_last_ids = dict(results_last_ids)
+    # the number of buckets Solr returned for each facet on this "page"
+    results_page_buckets = dict.fromkeys(results_last_ids, 0)
+    # the total number of buckets for each facet (if we asked for them)
+    results_num_buckets = dict.fromkeys(results_last_ids, 0)
+
+    # Send the query parameters in the body of a POST request rather than in
+    # the URL, as the JSON facet parameter is quite long.
+    with SESSION.post(solr_url, data=solr_query_params, timeout=60, stream=True) as res:
+        # Fail loudly if Solr returned an error, otherwise we would parse the
+        # error response as if there were no item views or downloads.
+        res.raise_for_status()
+
+        # make sure we get decompressed content if Solr used gzip
+        res.raw.decode_content = True
+
+        # write buckets to the CSV buffers as they are parsed (Solr omits a
+        # facet entirely if it has no matching buckets)
+        for column, field, value in parse_facets(res.raw, results_last_ids):
+            if field == "numBuckets":
+                results_num_buckets[column] = value
 
-            if not pattern.match(core):
                 continue
 
-            # Append current core to list
-            statistics_core_years.append(core)
+            # Count every bucket Solr returned, so that a full "page" still
+            # means there may be more buckets after it.
+            results_page_buckets[column] += 1
 
-    # Initialize a string to hold our shards (may end up being empty if the Solr
-    # core has not been processed by stats-util).
-    shards = str()
+            item_id, item_count = value
 
-    if len(statistics_core_years) > 0:
-        # Begin building a string of shards starting with the default one
-        shards = f"{SOLR_SERVER}/statistics"
+            # The cursor filters documents, not terms. Fields like owningItem
+            # are multi-valued, so a document matching the cursor can bring
+            # along ids we already indexed on a previous "page". Skip them so
+            # they aren't copied twice.
+            last_id = cursor_last_ids[column]
+            if last_id is not None and item_id <= last_id:
+                continue
 
-        for core in statistics_core_years:
-            # Create a comma-separated list of shards to pass to our Solr query
-            #
-            # See: https://wiki.apache.org/solr/DistributedSearch
-            shards += f",{SOLR_SERVER}/{core}"
-
-    # Return the string of shards, which may actually be empty. Solr doesn't
-    # seem to mind if the shards query parameter is empty and I haven't seen
-    # any negative performance impact so this should be fine.
-    return shards
-
-
-def index_views():
-    # get total number of distinct facets for items with a minimum of 1 view,
-    # otherwise Solr returns all kinds of weird ids that are actually not in
-    # the database. Also, stats are expensive, but we need stats.calcdistinct
-    # so we can get the countDistinct summary.
-    #
-    # see: https://lucene.apache.org/solr/guide/6_6/the-stats-component.html
-    solr_query_params = {
-        "q": "type:2",
-        "fq": "isBot:false AND statistics_type:view",
-        "facet": "true",
-        "facet.field": "id",
-        "facet.mincount": 1,
-        "facet.limit": 1,
-        "facet.offset": 0,
-        "stats": "true",
-        "stats.field": "id",
-        "stats.calcdistinct": "true",
-        "shards": shards,
-        "rows": 0,
-        "wt": "json",
-    }
-
-    solr_url = SOLR_SERVER + "/statistics/select"
-
-    res = requests.get(solr_url, params=solr_query_params)
-
-    try:
-        # get total number of distinct facets (countDistinct)
-        results_totalNumFacets = res.json()["stats"]["stats_fields"]["id"][
-            "countDistinct"
-        ]
-    except TypeError:
-        print("No item views to index, exiting.")
-
-        exit(0)
-
-    # divide results into "pages" (cast to int to effectively round down)
-    results_per_page = 100
-    results_num_pages = int(results_totalNumFacets / results_per_page)
-    results_current_page = 0
+            bufs[column].write(f"{item_id},{item_count}\n")
 
-    with DatabaseManager() as db:
-        with db.cursor() as cursor:
-            # create an empty list to store values for batch insertion
-            data = []
+            results_last_ids[column] = item_id
 
-            while results_current_page <= results_num_pages:
-                # "pages" are zero based, but one based is more human readable
-                print(
-                    f"Indexing item views (page {results_current_page + 1} of {results_num_pages + 1})"
-                )
+    for column, last_id in cursor_last_ids.items():
+        # If a full "page" only had ids we already indexed the cursor would
+        # never move forward, so stop rather than request the same page forever
+        page_full = results_page_buckets[column] == results_per_page
+        if page_full and results_last_ids[column] == last_id:
+            raise RuntimeError(
+                f"Cursor for {column} in {shard} did not advance past {last_id}"
+            )
 
-                solr_query_params = {
-                    "q": "type:2",
-                    "fq": "isBot:false AND statistics_type:view",
-                    "facet": "true",
-                    "facet.field": "id",
-                    "facet.mincount": 1,
-                    "facet.limit": results_per_page,
-                    "facet.offset": results_current_page * results_per_page,
-                    "shards": shards,
-                    "rows": 0,
-                    "wt": "json",
-                    "json.nl": "map",  # return facets as a dict instead of a flat list
-                }
-
-                solr_url = SOLR_SERVER + "/statistics/select"
-
-                res = requests.get(solr_url, params=solr_query_params)
-
-                # Solr returns facets as a dict of dicts (see json.nl parameter)
-                views = res.json()["facet_counts"]["facet_fields"]
-                # iterate over the 'id' dict and get the item ids and views
-                for item_id, item_views in views["id"].items():
-                    data.append((item_id, item_views))
-
-                # do a batch insert of values from the current "page" of results
-                sql = "INSERT INTO items(id, views) VALUES %s ON CONFLICT(id) DO UPDATE SET views=excluded.views"
-                psycopg2.extras.execute_values(cursor, sql, data, template="(%s, %s)")
-                db.commit()
-
-                # clear all items from the list so we can populate it with the next batch
-                data.clear()
-
-                results_current_page += 1
-
-
-def index_downloads():
-    # get the total number of distinct facets for items with at least 1 download
-    solr_query_params = {
-        "q": "type:0",
-        "fq": "isBot:false AND statistics_type:view AND bundleName:ORIGINAL",
-        "facet": "true",
-        "facet.field": "owningItem",
-        "facet.mincount": 1,
-        "facet.limit": 1,
-        "facet.offset": 0,
-        "stats": "true",
-        "stats.field": "owningItem",
-        "stats.calcdistinct": "true",
-        "shards": shards,
-        "rows": 0,
-        "wt": "json",
-    }
-
-    solr_url = SOLR_SERVER + "/statistics/select"
-
-    res = requests.get(solr_url, params=solr_query_params)
-
-    try:
-        # get total number of distinct facets (countDistinct)
-        results_totalNumFacets = res.json()["stats"]["stats_fields"]["owningItem"][
-            "countDistinct"
-        ]
-    except TypeError:
-        print("No item downloads to index, exiting.")
-
-        exit(0)
-
-    # divide results into "pages" (cast to int to effectively round down)
-    results_per_page = 100
-    results_num_pages = int(results_totalNumFacets / results_per_page)
-    results_current_page = 0
+    return bufs, results_last_ids, results_page_buckets, results_num_buckets
 
+
+# Create the tables for item views and downloads and for indexer runs if they
+# don't exist yet.
+def create_tables():
     with DatabaseManager() as db:
         with db.cursor() as cursor:
-            # create an empty list to store values for batch insertion
-            data = []
-
-            while results_current_page <= results_num_pages:
-                # "pages" are zero based, but one based is more human readable
-                print(
-                    f"Indexing item downloads (page {results_current_page + 1} of {results_num_pages + 1})"
+            # create table to store item views and downloads
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS items
+                      (id UUID PRIMARY KEY, views INT DEFAULT 0, downloads INT DEFAULT 0)"""
+            )
+
+            # create table to store the time up until which each run indexed
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS runs (time TIMESTAMP WITH TIME ZONE NOT NULL)"
+            )
+
+        # commit the table creation before closing the database connection
+        db.commit()
+
+
+def index_statistics():
+    results_per_page = RESULTS_PER_PAGE
+    # the total number of "pages" for each shard, which we only know after the
+    # first request to that shard
+    results_num_pages = dict()
+
+    # Use a small pool of threads to fetch "pages" from several shards at the
+    # same time, and to fetch the next "page" from a shard while we copy the
+    # current one into PostgreSQL. We limit the number of threads so we don't
+    # overwhelm Solr.
+    with ThreadPoolExecutor(max_workers=4) as executor, DatabaseManager() as db:
+        with db.cursor() as cursor:
+            # Everything is written in a single transaction that is committed
+            # once at the end, so we don't need to wait for the WAL to be
+            # flushed to disk. At worst a crash loses this run along with its
+            # entry in the runs table, so the next run indexes the same events
+            # again. Incremental runs add to the existing counts, so they are
+            # not idempotent, which is why we lock the runs table below.
+            #
+            # See: https://www.postgresql.org/docs/current/wal-async-commit.html
+            cursor.execute("SET LOCAL synchronous_commit = off")
+
+            # create a temporary table to stage item views and downloads before
+            # merging them into the items table (it is dropped automatically
+            # when we commit). Item ids are staged as text and cast to UUIDs
+            # all at once when we merge. Like unlogged tables, temporary tables
+            # are not written to the WAL, so only the final merge is logged.
+            #
+            # See: https://www.postgresql.org/docs/current/sql-createtable.html
+            cursor.execute(
+                "CREATE TEMP TABLE items_stage(id TEXT, views INT, downloads INT) ON COMMIT DROP"
+            )
+
+            # Make sure only one indexer runs at a time, otherwise two runs
+            # could read the same last run and both add the same events to the
+            # counts. A second run waits here until this one commits and then
+            # continues from where this one stopped.
+            cursor.execute("LOCK TABLE runs IN EXCLUSIVE MODE")
+
+            # Only index events since the last run, if there was one, and up
+            # until this run (see SOLR_COMMIT_LAG) so that the next run can
+            # continue from exactly where this one stopped.
+            cursor.execute("SELECT MAX(time) FROM runs")
+            last_run = cursor.fetchone()[0]
+            this_run = datetime.now(timezone.utc).replace(microsecond=0)
+            this_run -= SOLR_COMMIT_LAG
+
+            if last_run is None:
+                print("Indexing all item views and downloads")
+
+                time_filter = f"time:[* TO {solr_datetime(this_run)}}}"
+            else:
+                print(f"Indexing item views and downloads since {last_run}")
+
+                time_filter = (
+                    f"time:[{solr_datetime(last_run)} TO {solr_datetime(this_run)}}}"
                 )
 
-                solr_query_params = {
-                    "q": "type:0",
-                    "fq": "isBot:false AND statistics_type:view AND bundleName:ORIGINAL",
-                    "facet": "true",
-                    "facet.field": "owningItem",
-                    "facet.mincount": 1,
-                    "facet.limit": results_per_page,
-                    "facet.offset": results_current_page * results_per_page,
-                    "shards": shards,
-                    "rows": 0,
-                    "wt": "json",
-                    "json.nl": "map",  # return facets as a dict instead of a flat list
-                }
-
-                solr_url = SOLR_SERVER + "/statistics/select"
-
-                res = requests.get(solr_url, params=solr_query_params)
-
-                # Solr returns facets as a dict of dicts (see json.nl parameter)
-                downloads = res.json()["facet_counts"]["facet_fields"]
-                # iterate over the 'owningItem' dict and get the item ids and downloads
-                for item_id, item_downloads in downloads["owningItem"].items():
-                    data.append((item_id, item_downloads))
-
-                # do a batch insert of values from the current "page" of results
-                sql = "INSERT INTO items(id, downloads) VALUES %s ON CONFLICT(id) DO UPDATE SET downloads=excluded.downloads"
-                psycopg2.extras.execute_values(cursor, sql, data, template="(%s, %s)")
-                db.commit()
-
-                # clear all items from the list so we can populate it with the next batch
-                data.clear()
-
-                results_current_page += 1
-
-
-with DatabaseManager() as db:
-    with db.cursor() as cursor:
-        # create table to store item views and downloads
-        cursor.execute(
-            """CREATE TABLE IF NOT EXISTS items
-                  (id UUID PRIMARY KEY, views INT DEFAULT 0, downloads INT DEFAULT 0)"""
-        )
+            shards = get_statistics_shards()
+            results_current_page = dict.fromkeys(shards, 0)
 
-    # commit the table creation before closing the database connection
-    db.commit()
-
-shards = get_statistics_shards()
-
-index_views()
-index_downloads()
+            # The query parameters that are the same for every "page". We use
+            # a separate filter query for each condition because Solr caches
+            # them individually and can reuse them for every "page".
+            #
+            # See: https://lucene.apache.org/solr/guide/7_7/common-query-parameters.html#fq-filter-query-parameter
+            solr_query_params = {
+                "q": "*:*",
+                "fq": ["isBot:false", "statistics_type:view", time_filter],
+                "rows": 0,
+                "wt": "json",
+            }
+
+            # Start fetching the first "page" from every shard, with no last
+            # item ids yet, and only count the buckets on the first "page". We
+            # keep track of which shard each pending request is for.
+            futures = {
+                executor.submit(
+                    get_facets_page,
+                    shard,
+                    solr_query_params,
+                    dict.fromkeys(FACETS),
+                    results_per_page,
+                    True,
+                ): shard
+                for shard in shards
+            }
+
+            while futures:
+                # copy "pages" into PostgreSQL in whatever order they arrive
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    shard = futures.pop(future)
+                    (
+                        bufs,
+                        results_last_ids,
+                        results_page_buckets,
+                        results_num_buckets,
+                    ) = future.result()
+
+                    # Only keep asking for facets that filled this "page", as
+                    # the others returned fewer buckets than we asked for and
+                    # have no more. This shard is done when there are none.
+                    results_last_ids = {
+                        column: last_id
+                        for column, last_id in results_last_ids.items()
+                        if results_page_buckets[column] == results_per_page
+                    }
+
+                    # start fetching the next "page" now that we know the cursor
+                    if results_last_ids:
+                        next_future = executor.submit(
+                            get_facets_page,
+                            shard,
+                            solr_query_params,
+                            results_last_ids,
+                            results_per_page,
+                            False,
+                        )
+                        futures[next_future] = shard
+
+                    # skip shards that have no item views or downloads at all
+                    if not any(results_page_buckets.values()):
+                        continue
+
+                    if shard not in results_num_pages:
+                        # get the number of distinct items from the facet with
+                        # the most buckets (this is only used for displaying
+                        # progress)
+                        results_totalNumFacets = max(results_num_buckets.values())
+                        results_num_pages[shard] = math.ceil(
+                            results_totalNumFacets / results_per_page
+                        )
+
+                    # "pages" are zero based, but one based is more human readable
+                    print(
+                        f"Indexing item views and downloads from {shard} (page {results_current_page[shard] + 1} of {results_num_pages[shard]})"
+                    )
+
+                    # rewind the buffers and copy this page into the staging
+                    # table
+                    #
+                    # See: https://www.postgresql.org/docs/current/sql-copy.html
+                    for column, buf in bufs.items():
+                        buf.seek(0)
+                        cursor.copy_expert(
+                            f"COPY items_stage(id, {column}) FROM STDIN WITH CSV", buf
+                        )
+
+                    results_current_page[shard] += 1
+
+            if not any(results_current_page.values()):
+                print("No item views or downloads to index.")
+
+            if last_run is None:
+                # replace any existing counts with the ones from this run
+                sql_update = "views=excluded.views, downloads=excluded.downloads"
+            else:
+                # add the counts since the last run to the existing ones
+                sql_update = "views=items.views+excluded.views, downloads=items.downloads+excluded.downloads"
+
+            # merge the staged rows into the items table in one statement,
+            # adding up the counts for each item from all shards
+            cursor.execute(
+                f"""INSERT INTO items(id, views, downloads)
+                      SELECT id::uuid, COALESCE(SUM(views), 0), COALESCE(SUM(downloads), 0)
+                      FROM items_stage GROUP BY id
+                      ON CONFLICT(id) DO UPDATE SET {sql_update}"""
+            )
+
+            # record this run so the next one can continue from here
+            cursor.execute("INSERT INTO runs(time) VALUES (%s)", [this_run])
+
+        db.commit()
+
+
+if __name__ == "__main__":
+    create_tables()
+    index_statistics()
 
 # vim: set sw=4 ts=4 expandtab:
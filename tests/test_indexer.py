@@ -0,0 +1,379 @@
+import io
+import json
+import re
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import requests
+
+from dspace_statistics_api import indexer
+from dspace_statistics_api.database import DatabaseManager
+
+BASE_PARAMS = {"q": "*:*", "rows": 0, "wt": "json"}
+
+# item ids used when indexing into the test database, so that we don't touch
+# the items that the API tests use
+ITEM_PREFIX = "00000000-0000-0000-0000-0000000000"
+ITEM_A, ITEM_B, ITEM_C, ITEM_D = (f"{ITEM_PREFIX}0{n}" for n in range(1, 5))
+
+
+class FakeSession:
+    """Return a canned Solr response and record the parameters we sent."""
+
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.data = None
+
+    def response(self, url):
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.url = url
+        response.raw = io.BytesIO(json.dumps(self.body).encode("utf-8"))
+
+        return response
+
+    def get(self, url, params=None, **kwargs):
+        self.data = params
+
+        return self.response(url)
+
+    def post(self, url, data=None, **kwargs):
+        self.data = data
+
+        return self.response(url)
+
+
+class FakeSolr(FakeSession):
+    """Answer facet queries for each shard from buckets held in memory."""
+
+    def __init__(self, shards):
+        super().__init__(None)
+        self.shards = shards
+        self.requests = []
+
+    def post(self, url, data=None, **kwargs):
+        shard = url.split("/")[-2]
+        json_facet = json.loads(data["json.facet"])
+        self.requests.append((shard, data["fq"], list(json_facet)))
+
+        self.body = {"facets": {"count": 1}}
+
+        for column, facet in json_facet.items():
+            buckets = sorted(self.shards[shard].get(column, {}).items())
+
+            # apply the cursor, for example: id:{"a" TO *]
+            for domain_filter in facet["domain"]["filter"][1:]:
+                last_id = re.search(r'\{"(.*)" TO \*\]', domain_filter).group(1)
+                buckets = [bucket for bucket in buckets if bucket[0] > last_id]
+
+            self.body["facets"][column] = {
+                "buckets": [
+                    {"val": val, "count": count}
+                    for val, count in buckets[: facet["limit"]]
+                ]
+            }
+
+            if facet["numBuckets"]:
+                self.body["facets"][column]["numBuckets"] = len(buckets)
+
+        return self.response(url)
+
+
+def facets_response(**facets):
+    """Build a JSON Facet API response with the given buckets per facet."""
+
+    body = {"facets": {"count": 1}}
+
+    for column, buckets in facets.items():
+        body["facets"][column] = {
+            "numBuckets": len(buckets),
+            "buckets": [{"val": val, "count": count} for val, count in buckets],
+        }
+
+    return body
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def install(body, status_code=200):
+        fake = FakeSession(body, status_code)
+        monkeypatch.setattr(indexer, "SESSION", fake)
+
+        return fake
+
+    return install
+
+
+def query(sql, params=None):
+    """Run a statement against the test database and return any rows."""
+
+    with DatabaseManager() as db:
+        with db.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall() if cursor.description else None
+
+        db.commit()
+
+    return rows
+
+
+def indexed_items():
+    """Return the views and downloads of the items indexed by the tests."""
+
+    rows = query(
+        "SELECT id::text, views, downloads FROM items WHERE id::text LIKE %s",
+        [f"{ITEM_PREFIX}%"],
+    )
+
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+
+@pytest.fixture
+def database():
+    """Start without previous runs and remove the indexed items afterwards."""
+
+    def cleanup():
+        query("TRUNCATE runs")
+        query("DELETE FROM items WHERE id::text LIKE %s", [f"{ITEM_PREFIX}%"])
+
+    indexer.create_tables()
+    cleanup()
+
+    yield
+
+    cleanup()
+
+
+def test_parse_facets():
+    """Test streaming buckets and bucket counts out of a facet response."""
+
+    body = facets_response(views=[("a", 1), ("b", 2)], downloads=[("c", 3)])
+    stream = io.BytesIO(json.dumps(body).encode("utf-8"))
+
+    results = list(indexer.parse_facets(stream, ["views", "downloads"]))
+
+    assert results == [
+        ("views", "numBuckets", 2),
+        ("views", "bucket", ("a", 1)),
+        ("views", "bucket", ("b", 2)),
+        ("downloads", "numBuckets", 1),
+        ("downloads", "bucket", ("c", 3)),
+    ]
+
+
+def test_parse_facets_only_requested():
+    """Test that facets we didn't ask for are ignored."""
+
+    body = facets_response(views=[("a", 1)], downloads=[("c", 3)])
+    stream = io.BytesIO(json.dumps(body).encode("utf-8"))
+
+    results = list(indexer.parse_facets(stream, ["downloads"]))
+
+    assert results == [
+        ("downloads", "numBuckets", 1),
+        ("downloads", "bucket", ("c", 3)),
+    ]
+
+
+def test_parse_facets_missing_facets():
+    """Test a response without facets, for example from an older Solr."""
+
+    body = {"response": {"numFound": 10, "docs": []}}
+    stream = io.BytesIO(json.dumps(body).encode("utf-8"))
+
+    with pytest.raises(ValueError):
+        list(indexer.parse_facets(stream, ["views", "downloads"]))
+
+
+def test_solr_datetime():
+    """Test formatting datetimes in other time zones for Solr."""
+
+    dt = datetime(2020, 3, 2, 15, 30, 0, tzinfo=timezone(timedelta(hours=3)))
+
+    assert indexer.solr_datetime(dt) == "2020-03-02T12:30:00Z"
+
+
+def test_get_statistics_shards_from_environment(monkeypatch):
+    """Test parsing the shards from the SOLR_SHARDS environment variable."""
+
+    monkeypatch.setattr(indexer, "SOLR_SHARDS", " statistics, statistics-2018,,")
+
+    assert indexer.get_statistics_shards() == ["statistics", "statistics-2018"]
+
+
+def test_get_statistics_shards(monkeypatch, session):
+    """Test discovering the yearly statistics shards from Solr."""
+
+    monkeypatch.setattr(indexer, "SOLR_SHARDS", "")
+    fake = session(
+        {"status": {"oai": {}, "search": {}, "statistics": {}, "statistics-2018": {}}}
+    )
+
+    assert indexer.get_statistics_shards() == ["statistics", "statistics-2018"]
+    assert fake.data["action"] == "STATUS"
+
+
+def test_get_statistics_shards_solr_error(monkeypatch, session):
+    """Test that an error listing the Solr cores is not treated as no shards."""
+
+    monkeypatch.setattr(indexer, "SOLR_SHARDS", "")
+    session({"error": {"msg": "Server error", "code": 500}}, status_code=500)
+
+    with pytest.raises(requests.HTTPError):
+        indexer.get_statistics_shards()
+
+
+def test_get_facets_page(session):
+    """Test fetching the first page of facets."""
+
+    fake = session(facets_response(views=[("a", 1), ("b", 2)], downloads=[]))
+
+    bufs, last_ids, page_buckets, num_buckets = indexer.get_facets_page(
+        "statistics", BASE_PARAMS, {"views": None, "downloads": None}, 2, True
+    )
+
+    assert bufs["views"].getvalue() == "a,1\nb,2\n"
+    assert bufs["downloads"].getvalue() == ""
+    assert last_ids == {"views": "b", "downloads": None}
+    assert page_buckets == {"views": 2, "downloads": 0}
+    assert num_buckets == {"views": 2, "downloads": 0}
+
+    # the base parameters are not modified
+    assert "json.facet" not in BASE_PARAMS
+    assert json.loads(fake.data["json.facet"])["views"]["numBuckets"] is True
+
+
+def test_get_facets_page_cursor(session):
+    """Test fetching a page after the last item id of the previous one."""
+
+    fake = session(facets_response(downloads=[("n", 2), ("o", 3)]))
+
+    bufs, last_ids, page_buckets, _ = indexer.get_facets_page(
+        "statistics", BASE_PARAMS, {"downloads": "m"}, 2, False
+    )
+
+    json_facet = json.loads(fake.data["json.facet"])
+
+    assert list(json_facet) == ["downloads"]
+    assert 'owningItem:{"m" TO *]' in json_facet["downloads"]["domain"]["filter"]
+    assert bufs["downloads"].getvalue() == "n,2\no,3\n"
+    assert last_ids == {"downloads": "o"}
+    assert page_buckets == {"downloads": 2}
+
+
+def test_get_facets_page_multivalued(session):
+    """Test skipping ids from a previous page in multi-valued fields."""
+
+    # a document with owningItem=[a, n] matches the cursor, so Solr returns
+    # the bucket for a again even though we indexed it on a previous page
+    session(facets_response(downloads=[("a", 1), ("n", 2)]))
+
+    bufs, last_ids, page_buckets, _ = indexer.get_facets_page(
+        "statistics", BASE_PARAMS, {"downloads": "m"}, 10, False
+    )
+
+    assert bufs["downloads"].getvalue() == "n,2\n"
+    assert last_ids == {"downloads": "n"}
+    # skipped buckets still count towards a full page
+    assert page_buckets == {"downloads": 2}
+
+
+def test_get_facets_page_cursor_stuck(session):
+    """Test a full page that only has ids from previous pages."""
+
+    session(facets_response(downloads=[("a", 1), ("b", 2)]))
+
+    with pytest.raises(RuntimeError):
+        indexer.get_facets_page("statistics", BASE_PARAMS, {"downloads": "m"}, 2, False)
+
+
+def test_get_facets_page_solr_error(session):
+    """Test that Solr errors are raised instead of treated as no results."""
+
+    session({"error": {"msg": "undefined field", "code": 400}}, status_code=400)
+
+    with pytest.raises(requests.HTTPError):
+        indexer.get_facets_page(
+            "statistics", BASE_PARAMS, {"views": None, "downloads": None}, 2, True
+        )
+
+
+def test_index_statistics(monkeypatch, database):
+    """Test a full run and then an incremental run across two shards."""
+
+    monkeypatch.setattr(indexer, "SOLR_SHARDS", "statistics,statistics-2018")
+    monkeypatch.setattr(indexer, "RESULTS_PER_PAGE", 2)
+
+    # counts from an earlier index that the full run should replace
+    query("INSERT INTO items(id, views, downloads) VALUES (%s, 100, 100)", [ITEM_A])
+
+    solr = FakeSolr(
+        {
+            "statistics": {
+                "views": {ITEM_A: 1, ITEM_B: 2, ITEM_C: 3},
+                "downloads": {ITEM_A: 5},
+            },
+            "statistics-2018": {
+                "views": {ITEM_A: 10},
+                "downloads": {ITEM_B: 1, ITEM_C: 2, ITEM_D: 4},
+            },
+        }
+    )
+    monkeypatch.setattr(indexer, "SESSION", solr)
+
+    indexer.index_statistics()
+
+    assert indexed_items() == {
+        ITEM_A: (11, 5),
+        ITEM_B: (2, 1),
+        ITEM_C: (3, 2),
+        ITEM_D: (0, 4),
+    }
+
+    # each shard stops asking for a facet after its first partial page
+    assert sorted((shard, facets) for shard, _, facets in solr.requests) == [
+        ("statistics", ["views"]),
+        ("statistics", ["views", "downloads"]),
+        ("statistics-2018", ["downloads"]),
+        ("statistics-2018", ["views", "downloads"]),
+    ]
+    assert all(fq[-1].startswith("time:[* TO ") for _, fq, _ in solr.requests)
+
+    [(last_run,)] = query("SELECT time FROM runs")
+
+    solr = FakeSolr(
+        {
+            "statistics": {"views": {ITEM_B: 1}},
+            "statistics-2018": {"downloads": {ITEM_A: 2, ITEM_D: 1}},
+        }
+    )
+    monkeypatch.setattr(indexer, "SESSION", solr)
+
+    indexer.index_statistics()
+
+    # the incremental run adds to the existing counts
+    assert indexed_items() == {
+        ITEM_A: (11, 7),
+        ITEM_B: (3, 1),
+        ITEM_C: (3, 2),
+        ITEM_D: (0, 5),
+    }
+
+    # and only asks for events since the previous run
+    time_filter = f"time:[{indexer.solr_datetime(last_run)} TO "
+    assert all(fq[-1].startswith(time_filter) for _, fq, _ in solr.requests)
+    assert len(query("SELECT time FROM runs")) == 2
+
+
+def test_index_statistics_no_shards(monkeypatch, database):
+    """Test that a Solr error aborts the run without recording it."""
+
+    monkeypatch.setattr(indexer, "SOLR_SHARDS", "")
+    session = FakeSession({"error": {"code": 500}}, status_code=500)
+    monkeypatch.setattr(indexer, "SESSION", session)
+
+    with pytest.raises(requests.HTTPError):
+        indexer.index_statistics()
+
+    assert query("SELECT time FROM runs") == []